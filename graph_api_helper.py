@@ -1,4 +1,6 @@
+import datetime
 import json
+import os
 import requests
 import graph_auth_helper
 import pyodbc
@@ -21,6 +23,18 @@ sess_graph_j.headers.update({
     'Content-Type': 'application/json'
 })
 
+# Mutation ledger. Users whose adds failed permanently (e.g. 404 for unlicensed users)
+# are skipped until the cooldown expires. The cooldown should span at least one nightly run.
+failed_users = {}
+if os.path.exists('cached_mutations.json'):
+    with open('cached_mutations.json') as file_mutations:
+        failed_users = json.load(file_mutations).get('failed_users', {})
+failed_user_cooldown = datetime.timedelta(
+    days=config.get('failed_mutation_cooldown_days', 7))
+
+# Classes that Graph API could not return yet, usually because they are still being provisioned
+provisioning_classes = set()
+
 
 def debug_print(x):
     """Attempt to print JSON without altering it, serializable objects as JSON, and anything else as default."""
@@ -34,6 +48,60 @@ def debug_print(x):
                 print(x)
 
 
+def skip_failed_user(user_id):
+    """Returns True if adding the user failed permanently within the cooldown period."""
+
+    if user_id not in failed_users:
+        return False
+
+    failed_at = datetime.datetime.fromisoformat(
+        failed_users[user_id]['failed at'])
+    if datetime.datetime.now() - failed_at < failed_user_cooldown:
+        debug_print({'skip previously failed user': user_id,
+                     'failed at': failed_users[user_id]['failed at']})
+        return True
+
+    # Cooldown expired; try again
+    del failed_users[user_id]
+    return False
+
+
+def is_user_error(r, user_id):
+    """Returns True if a Graph API error response is about the user rather than the class or group.
+    Expects Graph to name the missing object in the error message, e.g. "Resource '<id>' does not exist..."
+    Responses that don't match are debug printed so the check can be verified against real errors.
+    """
+    try:
+        if user_id in json.loads(r.text)['error']['message']:
+            return True
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    debug_print({'404 not recorded in mutation ledger': user_id,
+                 'response': r.text})
+    return False
+
+
+def record_failed_user(operation, target_id, user_id):
+    """Remembers a user whose add failed permanently so that all adds for them are skipped until the cooldown expires.
+    Saves the ledger immediately so the failure survives a later crash.
+    """
+    failed_users[user_id] = {
+        'failed at': datetime.datetime.now().isoformat(),
+        'operation': operation,
+        'target': target_id
+    }
+    save_mutation_ledger()
+
+
+def save_mutation_ledger():
+    """Writes failed users to disk so they can be skipped by later runs."""
+    with open('cached_mutations.json', mode='w') as dump_file:
+        json.dump({'description': 'Users whose adds failed permanently, with the time of failure.',
+                   'failed_users': failed_users
+                   }, dump_file, indent=4)
+
+
 def get_classes():
     """Returns a list of class-type Teams. Does not return classes missing the classCode property or archived classes."""
 
@@ -66,6 +134,7 @@ def get_classes():
             # Graph API tends to 404 or 500 on newly-created Teams
             if r.status_code == 404 or r.status_code == 500:
                 t_class['isArchived'] = None
+                provisioning_classes.add(t_class['id'])
             # Retry bad gateway errors up to 10 times
             elif r.status_code == 502:
                 debug_print(r.text)
@@ -147,12 +216,17 @@ def create_class(name, description, class_code, external_id, mail, term, externa
 
 
 def add_class_teacher(class_id, teacher_id):
-    """Adds a teacher to a Team. Returns HTTP status code; 204 indicates success."""
+    """Adds a teacher to a Team. Returns HTTP status code; 204 indicates success.
+    Returns None if skipped by the mutation ledger.
+    """
 
     body = {
         '@odata.id': graph_endpoint + '/education/users/' + teacher_id
     }
 
+    if skip_failed_user(teacher_id):
+        return None
+
     if config['dry_run']:
         return None
     else:
@@ -164,12 +238,17 @@ def add_class_teacher(class_id, teacher_id):
 
 
 def add_class_student(class_id, student_id):
-    """Adds a student to a Team. Returns HTTP status code; 204 indicates success."""
+    """Adds a student to a Team. Returns HTTP status code; 204 indicates success.
+    Returns None if skipped by the mutation ledger.
+    """
 
     body = {
         '@odata.id': graph_endpoint + '/education/users/' + student_id
     }
 
+    if skip_failed_user(student_id):
+        return None
+
     if config['dry_run']:
         return None
     else:
@@ -182,6 +261,10 @@ def add_class_student(class_id, student_id):
             # Why does this 404 sometimes? User licensing issue?
             if r.status_code == 404:
                 debug_print(r.text)
+                # Newly-created classes also 404 until provisioned, so only remember user errors
+                if class_id not in provisioning_classes and is_user_error(r, student_id):
+                    record_failed_user(
+                        'add_class_student', class_id, student_id)
             else:
                 raise
         return r.status_code
@@ -275,12 +358,17 @@ def get_group_members(group_id):
 
 
 def add_group_member(group_id, user_id):
-    """Adds a member to an Office 365 Group. Returns HTTP status code; 204 indicates success."""
+    """Adds a member to an Office 365 Group. Returns HTTP status code; 204 indicates success.
+    Returns None if skipped by the mutation ledger.
+    """
 
     body = {
         '@odata.id': graph_endpoint + '/directoryObjects/' + user_id
     }
 
+    if skip_failed_user(user_id):
+        return None
+
     if config['dry_run']:
         return None
     else:
@@ -295,6 +383,9 @@ def add_group_member(group_id, user_id):
             # Why does this 404 sometimes? User licensing issue?
             if r.status_code == 404:
                 debug_print(r.text)
+                if is_user_error(r, user_id):
+                    record_failed_user(
+                        'add_group_member', group_id, user_id)
             else:
                 raise
         return r.status_code
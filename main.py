@@ -3,6 +3,7 @@ import graph_auth_helper
 import graph_api_helper
 import json
 import pyodbc
+import profile_helper
 
 
 def debug_print(x):
@@ -111,11 +112,31 @@ def get_user_id(PEOPLE_CODE_ID):
     return cached_users[PEOPLE_CODE_ID]['userId']
 
 
+def diff_members(current, wanted, keep=frozenset()):
+    """Compares current and wanted sets of userId's. Returns a tuple of (to_add, to_remove).
+    Users in keep are never removed.
+    """
+    return wanted - current, current - wanted - keep
+
+
 # Read config file
 with open('settings.json') as config_file:
     config = json.load(config_file)
 debug_print(config)
 
+# Optional profiling of the whole run, each phase, and each helper function
+# "profile": "timings" skips cProfile and its overhead; "full" (or true) includes it
+if config.get('profile', False):
+    profile_helper.start(
+        'timings' if config['profile'] == 'timings' else 'full')
+    profile_helper.wrap_module(graph_api_helper)
+    debug_print = profile_helper.timed(debug_print)
+    clean_sql_json = profile_helper.timed(clean_sql_json)
+    get_userPrincipalName = profile_helper.timed(get_userPrincipalName)
+    get_user_id = profile_helper.timed(get_user_id)
+    diff_members = profile_helper.timed(diff_members)
+profile_helper.phase('connect to PowerCampus')
+
 graph_endpoint = config['Microsoft']['graph_endpoint']
 
 # Microsoft SQL Server connection.
@@ -136,6 +157,7 @@ debug_print({
 with open('get_userPrincipalName.sql') as sql:
     get_userPrincipalName_sql = sql.read()
 
+profile_helper.phase('get sections')
 # Load cached users
 if config['clear_cache_users'] == False:
     with open('cached_users.json') as file_users:
@@ -161,11 +183,13 @@ else:
 
 debug_print(sections)
 
+profile_helper.phase('fetch Teams classes')
 print('Fetching Teams classes.')
 # Get list of Teams classes.
 teams_classes = graph_api_helper.get_classes()
 debug_print({'current Teams classes': teams_classes})
 
+profile_helper.phase('update classes')
 print('Updating classes.')
 # Compare to sections and create any new classes.
 # Newly-created classes will not have members added immediately; Office 365 usually takes some minutes to provision a new class.
@@ -192,6 +216,7 @@ for t_class in teams_classes:
 # Remove archived teams classes from list.
 teams_classes[:] = [t_class for t_class in teams_classes if 'Delete' not in t_class]
 
+profile_helper.phase('update class members')
 print('Updating members in classes.')
 for t_class in teams_classes:
     pos = teams_classes.index(t_class) + 1
@@ -215,14 +240,15 @@ for t_class in teams_classes:
     # Make lists into unordered, unique sets and remove None
     t_teachers = set(t_teachers) - {None}
     pc_teachers = set(pc_teachers) - {None}
+    add_teachers, remove_teachers = diff_members(t_teachers, pc_teachers)
 
     # Add new teachers from sections.
-    for teacher in pc_teachers.difference(t_teachers):
+    for teacher in add_teachers:
         debug_print({'class': t_class['classCode'], 'add teacher': teacher})
         graph_api_helper.add_class_teacher(t_class['id'], teacher)
 
     # Remove extra teachers not in sections.
-    for teacher in t_teachers.difference(pc_teachers):
+    for teacher in remove_teachers:
         debug_print({'class': t_class['classCode'], 'remove teacher': teacher})
         graph_api_helper.remove_class_teacher(t_class['id'], teacher)
 
@@ -242,15 +268,18 @@ for t_class in teams_classes:
     # Make lists into unordered, unique sets and remove None
     t_members = set(t_members) - {None}
     pc_students = set(pc_students) - {None}
+    # Teachers are already class members, so skip anyone who is also a teacher of this class.
+    # Because get_class_members() returns students + teachers, keep both teachers sets when removing.
+    add_students, remove_students = diff_members(
+        t_members, pc_students - pc_teachers, t_teachers | pc_teachers)
 
     # Add new students from sections.
-    for student in pc_students.difference(t_members):
+    for student in add_students:
         debug_print({'class': t_class['classCode'], 'add student': student})
         graph_api_helper.add_class_student(t_class['id'], student)
 
     # Remove extra students not in sections.
-    # Because get_class_members() returns students + teachers, include teachers set when comparing.
-    for student in set(t_members - t_teachers).difference(pc_students):
+    for student in remove_students:
         debug_print({'class': t_class['classCode'], 'remove student': student})
         graph_api_helper.remove_class_student(t_class['id'], student)
 
@@ -259,6 +288,7 @@ with open('cached_users.json', mode='w') as dump_file:
                'cache': cached_users
                }, dump_file, indent=4)
 
+profile_helper.phase('update Faculty group')
 print('Updating Faculty group members.')
 # Update members of existing Faculty team
 faculty_team = config['Microsoft']['faculty_team']
@@ -281,6 +311,7 @@ t_owners = set(t_owners) - {None}
 t_members = set(t_members) - {None}
 
 
+profile_helper.phase('update Student group')
 print('Updating Student group members.')
 # Update members of existing Student team
 student_team = config['Microsoft']['student_team']
@@ -301,17 +332,22 @@ pc_students = [get_user_id(t_user) for t_user in pc_students_pcid]
 pc_students = set(pc_students) - {None}
 t_owners = set(t_owners) - {None}
 t_members = set(t_members) - {None}
+add_students, remove_students = diff_members(t_members, pc_students, t_owners)
 
 # Add new students from sections.
-for student in pc_students.difference(t_members):
+for student in add_students:
     debug_print({'add to Students team': student})
     graph_api_helper.add_group_member(student_team, student)
 
 # Remove extra students not in sections.
-for student in set(t_members - t_owners).difference(pc_students):
+for student in remove_students:
     debug_print({'remove from Students team': student})
     graph_api_helper.remove_group_member(student_team, student)
 
+profile_helper.phase('write caches')
+# Save failed mutations so later runs can skip them
+graph_api_helper.save_mutation_ledger()
+
 # Parse cached_users and output suspicious entries to file
 error_users = {}
 
@@ -324,9 +360,19 @@ for PCID, results in cached_users.items():
         if value is None:
             error_users[PCID] = cached_users[PCID]
 
+# Include users held back by the mutation ledger after a failed add
+for PCID, results in cached_users.items():
+    if results.get('userId') in graph_api_helper.failed_users:
+        error_users[PCID] = dict(
+            results, failed_add=graph_api_helper.failed_users[results['userId']])
+
 with open('error_users.json', mode='w') as dump_file:
     json.dump({'description': 'Users with possible error states.',
                'users': error_users
                }, dump_file, indent=4)
 
+profile_name = profile_helper.stop()
+if profile_name is not None:
+    print('Profile written to ' + profile_name + '.*')
+
 print('Finished!')
@@ -0,0 +1,177 @@
+import atexit
+import cProfile
+import datetime
+import functools
+import inspect
+import io
+import json
+import pstats
+import time
+
+# Opt-in profiling. Each phase records wall time vs. CPU time; wall time not spent on CPU is
+# mostly waiting on the network (Graph API) or SQL Server. In timings mode, each watched
+# function is wrapped to record the same. In full mode, cProfile records the whole run instead,
+# and function timings are taken from its stats so that call paths are not hidden behind a wrapper.
+profiler = cProfile.Profile()
+enabled = False
+full = False
+timings = {'phases': {}, 'functions': {}}
+current_phase = None
+# Child time accumulated by each active timed() call, used to compute self time
+call_stack = []
+# Functions to report in full mode, keyed by cProfile's (filename, line, name) label
+watched = {}
+
+
+def _record(kind, name, wall, cpu, self_wall=None, self_cpu=None):
+    """Adds a measurement to the timings summary."""
+    entry = timings[kind].setdefault(
+        name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+    entry['calls'] += 1
+    entry['wall_seconds'] += wall
+    entry['cpu_seconds'] += cpu
+    if self_wall is not None:
+        entry['self_wall_seconds'] = entry.get(
+            'self_wall_seconds', 0.0) + self_wall
+        entry['self_cpu_seconds'] = entry.get(
+            'self_cpu_seconds', 0.0) + self_cpu
+
+
+def start(mode='full'):
+    """Enables profiling for the rest of the run. Artifacts are written when stop() is called or at exit.
+
+    mode 'timings' records only phase and function timings, without cProfile overhead.
+    mode 'full' also runs cProfile, which inflates CPU time for code making many small calls.
+    """
+    global enabled, full
+    enabled = True
+    full = mode == 'full'
+    atexit.register(stop)
+    if full:
+        profiler.enable()
+
+
+def phase(name):
+    """Marks the start of a new phase of the sync, ending the previous phase if any. Does nothing unless profiling is enabled."""
+    global current_phase
+
+    if not enabled:
+        return
+
+    now_wall = time.perf_counter()
+    now_cpu = time.process_time()
+    if current_phase is not None:
+        _record('phases', current_phase['name'], now_wall -
+                current_phase['wall'], now_cpu - current_phase['cpu'])
+
+    if name is None:
+        current_phase = None
+    else:
+        current_phase = {'name': name, 'wall': now_wall, 'cpu': now_cpu}
+
+
+def timed(func):
+    """Wraps a function to record its wall and CPU time. Returns the function unchanged unless profiling is enabled.
+    In full mode the function is also returned unchanged, and its timings are taken from cProfile stats instead.
+    """
+
+    if not enabled:
+        return func
+
+    if full:
+        code = func.__code__
+        watched[(code.co_filename, code.co_firstlineno, code.co_name)] = \
+            func.__module__ + '.' + func.__name__
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        call_stack.append([0.0, 0.0])
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            child_wall, child_cpu = call_stack.pop()
+            if call_stack:
+                call_stack[-1][0] += wall
+                call_stack[-1][1] += cpu
+            _record('functions', func.__module__ + '.' + func.__name__,
+                    wall, cpu, wall - child_wall, cpu - child_cpu)
+
+    return wrapper
+
+
+def wrap_module(module):
+    """Replaces every function defined in a module with a timed() version, including calls made within the module.
+    In full mode the functions are only registered for reporting and left unwrapped.
+    """
+    for name, func in inspect.getmembers(module, inspect.isfunction):
+        if func.__module__ == module.__name__:
+            setattr(module, name, timed(func))
+
+
+def stop():
+    """Ends the last phase, stops profiling, and writes profile artifacts. Returns the base file name used.
+
+    profile_<timestamp>.prof: raw cProfile stats, viewable with snakeviz or convertible to a flame graph. Full mode only.
+    profile_<timestamp>.txt: top functions by cumulative time. Full mode only.
+    profile_<timestamp>.json: wall, CPU, and wait time per phase and per wrapped function.
+    """
+    global enabled
+
+    if not enabled:
+        return None
+
+    phase(None)
+    enabled = False
+
+    base_name = 'profile_' + datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+
+    if full:
+        profiler.disable()
+        profiler.dump_stats(base_name + '.prof')
+
+        stats_text = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stats_text)
+        stats.sort_stats('cumulative').print_stats(50)
+        with open(base_name + '.txt', mode='w') as dump_file:
+            dump_file.write(stats_text.getvalue())
+
+        # cProfile times are wall time only, so there is no CPU or wait split per function in full mode
+        for label, (primitive_calls, calls, self_wall, wall, callers) in stats.stats.items():
+            if label in watched:
+                timings['functions'][watched[label]] = {
+                    'calls': calls,
+                    'wall_seconds': wall,
+                    'self_wall_seconds': self_wall
+                }
+
+    description = ('Wall time, Python CPU time, and wait time (wall minus CPU; mostly network) per phase and function. '
+                   'Function times are inclusive of any watched functions they call, so do not sum them; '
+                   'the self_ figures exclude those calls. '
+                   'Set differences in main.py are measured by diff_members.')
+    if full:
+        description += (' In full mode, function times come from cProfile and are wall time only, '
+                        'and self_wall_seconds excludes all calls, including library and built-in ones. '
+                        'Phase CPU times were measured while cProfile was running, which overstates CPU time '
+                        'and understates wait time for code making many small calls.')
+
+    for kind in timings.values():
+        for entry in kind.values():
+            if 'cpu_seconds' in entry:
+                entry['wait_seconds'] = max(
+                    entry['wall_seconds'] - entry['cpu_seconds'], 0.0)
+            if 'self_cpu_seconds' in entry:
+                entry['self_wait_seconds'] = max(
+                    entry['self_wall_seconds'] - entry['self_cpu_seconds'], 0.0)
+    with open(base_name + '.json', mode='w') as dump_file:
+        json.dump({'description': description,
+                   'mode': 'full' if full else 'timings',
+                   'phases': timings['phases'],
+                   'functions': timings['functions']
+                   }, dump_file, indent=4)
+
+    return base_name